@@ -39,6 +39,14 @@ class FluidSynth():
     def midi_to_audio(self, midi_file, audio_file):
         subprocess.call(['fluidsynth', '-ni', self.sound_font, midi_file, '-F', audio_file, '-r', str(self.sample_rate)])
 
+    def midi_to_raw(self, midi_file, raw_file):
+        """
+        Renders headerless 16-bit little-endian stereo PCM. There's no encoding
+        and no file size limit (unlike WAV).
+        """
+        subprocess.call(['fluidsynth', '-ni', '-T', 'raw', '-O', 's16', '-E', 'little',
+            self.sound_font, midi_file, '-F', raw_file, '-r', str(self.sample_rate)])
+
     def play_midi(self, midi_file):
         subprocess.call(['fluidsynth', '-i', self.sound_font, midi_file, '-r', str(self.sample_rate)])
 
@@ -3,21 +3,36 @@ This generates a single-tone audio clip for instrument classification.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
 from music21.chord import Chord
-from music21.duration import Duration
 from music21.instrument import Instrument
 from music21.note import Note, Rest
 from music21.stream import Stream
 from music21.tempo import MetronomeMark
 from music21.volume import Volume
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
 import soundfile as sf
+from symusic import Note as SymNote, Score, Tempo, Track
 
 from fluidsynth import FluidSynth
 from instruments import midi_instruments
 
+logger = logging.getLogger(__name__)
+
+TICKS_PER_QUARTER = 480
+
+# MIDI instruments used for random samples
+ALLOWED_INSTRUMENTS = np.hstack([
+        np.arange(0, 8), # piano
+        np.arange(16, 32), # organ, guitar
+        np.arange(40, 48), # strings
+        np.arange(56, 80), # brass, reed, pipe
+    ]).astype(np.int16)
+
 def make_instrument(id):
     i = Instrument()
     i.midiProgram = id
@@ -32,7 +47,7 @@ def write_midi(stream, output_file):
 
 def generate_single_note(midi_number, midi_instrument=0, volume=1.0, duration=1.0, tempo=120):
     """
-    Generates a stream containing a single note with given parameters.
+    Generates a symusic Score containing a single note with given parameters.
     midi_number - MIDI note number, 0 to 127
     midi_instrument - MIDI intrument number, 0 to 127
     duration - floating point number (in quarter note lengths)
@@ -40,14 +55,40 @@ def generate_single_note(midi_number, midi_instrument=0, volume=1.0, duration=1.
     tempo - number of quarter notes per minute (eg. 120)
 
     Note that there's a quarter note rest at the beginning and at the end.
+
+    Store it to a MIDI file via `score.dump_midi(midi_file)`.
     """
-    return Stream([
-        MetronomeMark(number=tempo),
-        make_instrument(int(midi_instrument)),
-        chord_with_volume(Chord([
-            Note(midi=int(midi_number), duration=Duration(duration))
-        ]), volume)
-    ])
+    score = Score(TICKS_PER_QUARTER)
+    score.tempos.append(Tempo(time=0, qpm=float(tempo)))
+    track = Track(program=int(midi_instrument))
+    track.notes.append(SymNote(
+        time=0,
+        duration=int(round(duration * TICKS_PER_QUARTER)),
+        pitch=int(midi_number),
+        velocity=int(round(volume * 127))))
+    score.tracks.append(track)
+    return score
+
+def _synthesize_one(args):
+    """
+    Writes a MIDI file for a single note and synthesizes it to audio.
+
+    `args` - tuple `(i, note_params, output_dir, audio_format)` where `note_params`
+    is a dict of generate_single_note arguments.
+
+    It's a top-level function so that it can be passed to a process pool.
+    Each call uses its own FluidSynth instance.
+    """
+    i, note_params, output_dir, audio_format = args
+
+    midi_file = f'{output_dir}/{i:06d}.midi'
+    audio_file = f'{output_dir}/{i:06d}.{audio_format}'
+
+    logger.debug('writing %s', audio_file)
+
+    score = generate_single_note(**note_params)
+    score.dump_midi(midi_file)
+    FluidSynth().midi_to_audio(midi_file, audio_file)
 
 def generate_separate_notes(note_params_df, output_dir, audio_format='flac'):
     """
@@ -58,19 +99,23 @@ def generate_separate_notes(note_params_df, output_dir, audio_format='flac'):
     `output_dir` - output directory for the MIDI files
 
     Each sample goes to a single MIDI file named by the numeric index. Also each synthesized audio sample goes to a
+
+    The samples are synthesized in parallel using all CPU cores.
     """
     os.makedirs(output_dir, exist_ok=True)
 
-    fs = FluidSynth()
-    for i, row in note_params_df.iterrows():
-        midi_file = '{0}/{1:06d}.midi'.format(output_dir, i)
-        audio_file = '{0}/{1:06d}.{2}'.format(output_dir, i, audio_format)
-
-        print(row, midi_file, audio_file)
+    tasks = [
+        (row.Index, {
+            'midi_number': row.midi_number,
+            'midi_instrument': row.midi_instrument,
+            'volume': row.volume,
+            'duration': row.duration,
+            'tempo': row.tempo,
+        }, output_dir, audio_format)
+        for row in note_params_df.itertuples(index=True)]
 
-        stream = generate_single_note(**row)
-        write_midi(stream, midi_file)
-        fs.midi_to_audio(midi_file, audio_file)
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        pool.map(_synthesize_one, tasks, chunksize=16)
 
 def random_params(n, note_range=None, volume_range=(0.5, 1.0), duration=1.0, tempo=60, seed=None):
     """
@@ -79,40 +124,33 @@ def random_params(n, note_range=None, volume_range=(0.5, 1.0), duration=1.0, tem
     n - number of samples
     """
 
-    if seed is not None:
-        np.random.seed(seed)
+    rng = np.random.default_rng(seed)
 
     instruments = midi_instruments()
 
-    def instrument_range(i):
-        instr = instruments.ix[i]
-        instr_range = np.array([instr['min_pitch'], instr['max_pitch']])
-        if note_range is not None:
-            instr_range = np.clip(instr_range, *note_range)
-        return instr_range
-
-    allowed_instruments = np.hstack([
-            np.arange(0, 8), # piano
-            np.arange(16, 32), # organ, guitar
-            np.arange(40, 48), # strings
-            np.arange(56, 80), # brass, reed, pipe
-        ])
-
-    def random_note_for_instrument(instr):
-        instr_range = instrument_range(instr)
-        return np.random.random_integers(low=instr_range[0], high=instr_range[1], size=1)[0]
-
-    df = pd.DataFrame()
-    df['midi_instrument'] = np.random.choice(allowed_instruments, size=n)
-    df['midi_number'] = df['midi_instrument'].apply(random_note_for_instrument)
-    df['volume'] = np.random.uniform(low=volume_range[0], high=volume_range[1], size=n)
-    # TODO: allow varying duration while maintaining constant audio length
-    df['duration'] = duration
-    df['tempo'] = tempo
+    # pitch ranges indexed by the instrument id
+    lo = instruments['min_pitch'].values
+    hi = instruments['max_pitch'].values
+    if note_range is not None:
+        lo = np.clip(lo, *note_range)
+        hi = np.clip(hi, *note_range)
+
+    instr_ids = rng.choice(ALLOWED_INSTRUMENTS, size=n)
+    midi_numbers = rng.integers(lo[instr_ids], hi[instr_ids], endpoint=True, dtype=np.int16)
+    volumes = rng.uniform(low=volume_range[0], high=volume_range[1], size=n)
+
+    df = pd.DataFrame({
+        'midi_instrument': instr_ids,
+        'midi_number': midi_numbers,
+        'volume': volumes,
+        # TODO: allow varying duration while maintaining constant audio length
+        'duration': np.full(n, duration, dtype=np.float32),
+        'tempo': np.full(n, tempo, dtype=np.int16),
+    }, columns=['midi_instrument', 'midi_number', 'volume', 'duration', 'tempo'])
 
     return df
 
-def generate_notes_in_batch(note_params_df, output_dir, audio_format='flac', sample_rate=44100):
+def generate_notes_in_batch(note_params_df, output_dir, audio_format='flac', sample_rate=44100, sample_files=True):
     """
     Generates a batch of single note samples from the given table of parameters.
 
@@ -121,6 +159,9 @@ def generate_notes_in_batch(note_params_df, output_dir, audio_format='flac', sam
     `output_dir` - output directory for the MIDI files
 
     Each sample goes to a single MIDI file named by the numeric index. Also each synthesized audio sample goes to a
+
+    All the cut samples are stored in a single 2D array in `samples.npy`. With
+    `sample_files` they're also stored in separate audio files.
     """
     os.makedirs(output_dir, exist_ok=True)
 
@@ -128,45 +169,73 @@ def generate_notes_in_batch(note_params_df, output_dir, audio_format='flac', sam
 
     stream = Stream()
 
-    for i, row in note_params_df.iterrows():
-        stream.append(MetronomeMark(number=row['tempo']))
-        stream.append(make_instrument(int(row['midi_instrument'])))
-        duration = row['duration']
+    # music21 objects can't be shared between positions in a stream, so at
+    # least emit the tempo mark only when the tempo changes
+    prev_tempo = None
+    for row in note_params_df.itertuples(index=True):
+        if row.tempo != prev_tempo:
+            stream.append(MetronomeMark(number=row.tempo))
+            prev_tempo = row.tempo
+        stream.append(make_instrument(int(row.midi_instrument)))
+        duration = row.duration
         stream.append(chord_with_volume(Chord([
-            Note(midi=int(row['midi_number']), duration=Duration(duration))
-        ]), row['volume']))
-        stream.append(Rest(duration=Duration(2 * duration)))
+            Note(midi=int(row.midi_number), quarterLength=duration)
+        ]), row.volume))
+        stream.append(Rest(quarterLength=2 * duration))
 
     midi_file = '{0}/all_samples.midi'.format(output_dir)
-    audio_file_stereo = '{0}/all_samples_stereo.{1}'.format(output_dir, audio_format)
+    audio_file_stereo = '{0}/all_samples_stereo.raw'.format(output_dir)
     audio_file = '{0}/all_samples.{1}'.format(output_dir, audio_format)
-    audio_index_file = '{0}/all_samples_index.csv'.format(output_dir)
+    audio_index_file = '{0}/all_samples_index.feather'.format(output_dir)
+    samples_file = '{0}/samples.npy'.format(output_dir)
 
     # TODO: We currently assume some fixed duration and tempo (1.0, 120)!!!
     # The parts should be split according to an index.
     audio_index = make_audio_index(note_params_df, 3.0, 0.5, sample_rate)
-    audio_index.to_csv(audio_index_file)
+    audio_index.to_feather(audio_index_file)
 
     write_midi(stream, midi_file)
 
-    fs.midi_to_audio(midi_file, audio_file_stereo)
+    fs.midi_to_raw(midi_file, audio_file_stereo)
 
-    convert_to_mono(audio_file_stereo, audio_file)
+    # downmix the raw stereo PCM and write the audio file just once
+    x = raw_stereo_to_mono(audio_file_stereo)
     os.remove(audio_file_stereo)
+    sf.write(audio_file, x, sample_rate)
+
+    # the synthesized audio may end before the end of the last part
+    audio_end = int(audio_index['end_samples'].iloc[-1]) if len(audio_index) > 0 else 0
+    if len(x) < audio_end:
+        x = np.pad(x, (0, audio_end - len(x)), mode='constant')
+
+    parts = list(split_audio_to_parts(x, sample_rate, audio_index))
+    np.save(samples_file, np.array(parts, dtype=np.float32))
+    if sample_files:
+        store_parts_to_files(parts, sample_rate, output_dir, audio_format)
 
-    x, sample_rate = sf.read(audio_file)
+def raw_stereo_to_mono(raw_file):
+    """
+    Downmixes a raw 16-bit little-endian stereo file to a mono float32 signal.
 
-    parts = split_audio_to_parts(x, sample_rate, audio_index)
-    store_parts_to_files(parts, sample_rate, output_dir, audio_format)
+    The file is memory-mapped, so no decoded stereo copy is kept in memory.
+    """
+    if os.path.getsize(raw_file) == 0:
+        return np.zeros(0, dtype=np.float32)
+    stereo = np.memmap(raw_file, dtype='<i2', mode='r').reshape(-1, 2)
+    x_mono = stereo.mean(axis=1, dtype=np.float32)
+    x_mono *= 1.0 / 32768
+    del stereo
+    return x_mono
 
 def convert_to_mono(stereo_file, mono_file):
-    x, sample_rate = sf.read(stereo_file)
-    x_mono = x.mean(axis=1) # convert to mono
+    # float32 is enough for 16-bit audio and halves the memory of the default float64
+    x, sample_rate = sf.read(stereo_file, dtype='float32', always_2d=True)
+    x_mono = x.mean(axis=1, dtype=np.float32) # convert to mono
     sf.write(mono_file, x_mono, sample_rate)
 
 def make_audio_index(note_params_df, part_duration, margin_duration, sample_rate):
     sample_count = len(note_params_df)
-    index = np.arange(sample_count)
+    index = np.arange(sample_count, dtype=np.int64)
 
     # let's have larger margin to prevent spilling the content
     # 1 second margin, 1 second note, 1 second margin
@@ -175,36 +244,53 @@ def make_audio_index(note_params_df, part_duration, margin_duration, sample_rate
     part_samples = int(part_duration * sample_rate)
     margin_samples = int(margin_duration * sample_rate)
 
-    audio_index = pd.DataFrame()
-
-    audio_index['start_samples'] = index * part_samples + margin_samples
-    audio_index['start_time'] = audio_index['start_samples'] / sample_rate
+    # int32 is enough for ~13.5 hours at 44.1 kHz, longer audio needs int64
+    fits_int32 = sample_count * part_samples <= np.iinfo(np.int32).max
+    dtype = np.int32 if fits_int32 else np.int64
+    start_samples = (index * part_samples + margin_samples).astype(dtype)
+    end_samples = ((index + 1) * part_samples - margin_samples).astype(dtype)
+    inv_sr = 1.0 / sample_rate
 
-    audio_index['end_samples'] = (index + 1) * part_samples - margin_samples
-    audio_index['end_time'] = audio_index['end_samples'] / sample_rate
-
-    return audio_index
+    return pd.DataFrame({
+        'start_samples': start_samples,
+        'start_time': start_samples * inv_sr,
+        'end_samples': end_samples,
+        'end_time': end_samples * inv_sr,
+    })
 
 def split_audio_to_parts(x, sample_rate, audio_index):
-    for i, row in audio_index.iterrows():
-        x_part = x[int(row['start_samples']):int(row['end_samples'])]
-        yield x_part
+    """
+    Yields the parts of the audio given by the index as views (no copying).
+    """
+    starts = audio_index['start_samples'].values.astype(np.int64)
+    ends = audio_index['end_samples'].values.astype(np.int64)
+    for start, end in zip(starts, ends):
+        yield x[start:end]
 
 def store_parts_to_files(parts, sample_rate, output_dir, audio_format):
     """
     Store the cut samples in separate files for easier human listening.
+
+    The files are independent, so they're encoded and written concurrently
+    (libsndfile releases the GIL).
     """
-    for i, x_part in enumerate(parts):
-        audio_file = output_dir + '/sample_{0:06d}.{1}'.format(i, audio_format)
-        print(audio_file)
-        sf.write(audio_file, x_part, sample_rate)
+    prefix = f'{output_dir}/sample_'
+
+    def store_part(i_part):
+        i, x_part = i_part
+        sf.write(f'{prefix}{i:06d}.{audio_format}', x_part, sample_rate)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        count = len(list(executor.map(store_part, enumerate(parts))))
+    logger.info('stored %d samples to %s', count, output_dir)
 
 def generate_random_samples(args):
     params_df = random_params(args.count, seed=args.seed)
     os.makedirs(args.output_dir, exist_ok=True)
-    params_df.to_csv(args.output_dir + '/parameters.csv')
+    params_df.to_parquet(args.output_dir + '/parameters.parquet')
     # generate_separate_notes(params_df, output_dir, args.audio_format)
-    generate_notes_in_batch(params_df, args.output_dir, args.audio_format)
+    generate_notes_in_batch(params_df, args.output_dir, args.audio_format,
+        sample_files=args.sample_files)
 
 class SingleToneDataset():
     """
@@ -212,13 +298,34 @@ class SingleToneDataset():
     """
     def __init__(self, path):
         self.path = path
-        self.params_file = path + '/parameters.csv'
-        self.params = pd.read_csv(self.params_file, index_col=0)
-        self.audio_index_file = path + '/all_samples_index.csv'
-        self.audio_index = pd.read_csv(self.audio_index_file, index_col=0)
+        self.params_file = path + '/parameters.parquet'
+        self.params = pd.read_parquet(self.params_file)
+        self.audio_index_file = path + '/all_samples_index.feather'
+        self.audio_index = pd.read_feather(self.audio_index_file)
         self.audio_file = path + '/all_samples.flac'
-        audio, self.sample_rate = sf.read(self.audio_file)
-        self.samples = np.array(list(split_audio_to_parts(audio, self.sample_rate, self.audio_index)))
+        self.samples_file = path + '/samples.npy'
+        self.sample_rate = sf.info(self.audio_file).samplerate
+        if os.path.exists(self.samples_file):
+            self.samples = np.load(self.samples_file, mmap_mode='r')
+        else:
+            self.samples = self._read_samples()
+
+    def _read_samples(self):
+        starts = self.audio_index['start_samples'].values
+        ends = self.audio_index['end_samples'].values
+        # all parts have the same length (see make_audio_index)
+        part_len = int(ends[0] - starts[0]) if len(starts) > 0 else 0
+        # zeros in case the audio ends before the last part
+        samples = np.zeros((len(starts), part_len), dtype=np.float32)
+        # decode just the parts directly into the samples array, without
+        # loading the whole audio (including the margins) into memory
+        with sf.SoundFile(self.audio_file) as f:
+            for i, start in enumerate(starts):
+                if start >= f.frames:
+                    break
+                f.seek(int(start))
+                f.read(dtype='float32', out=samples[i])
+        return samples
 
     def __repr__(self):
         return '<SingleToneDataset at {} of shape {}>'.format(self.path, self.samples.shape)
@@ -229,12 +336,15 @@ def parse_args():
     parser.add_argument('-s', '--seed', type=int, help='random seed')
     parser.add_argument('-o', '--output-dir', type=str, help='output directory')
     parser.add_argument('-f', '--audio-format', type=str, default='flac', help='audio format (flac, wav)')
+    parser.add_argument('--no-sample-files', dest='sample_files', action='store_false',
+        help='do not store each sample to a separate audio file (only samples.npy)')
 
     return parser.parse_args()
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     generate_random_samples(parse_args())
 
 # TODO: split into two parts with separate responsibilities:
-# - randomly generate the parameters to a CSV file
-# - synthesize sounds from a given CSV file
+# - randomly generate the parameters to a Parquet file
+# - synthesize sounds from a given Parquet file
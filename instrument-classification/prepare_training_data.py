@@ -32,7 +32,7 @@ def prepare_inputs(input_dir, output_dir, split_seed=42):
 
     ## Load targets
 
-    parameters = pd.read_csv(input_dir + '/parameters.csv', index_col=0)
+    parameters = pd.read_parquet(input_dir + '/parameters.parquet')
     print('parameters.shape:', parameters.shape)
 
     instruments = midi_instruments()